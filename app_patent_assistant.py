@@ -1,30 +1,60 @@
 import streamlit as st
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
 import re
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+# 특허 번호 감지용 정규식 엔진 (설치되어 있으면 Hyperscan → RE2 순으로 사용, 없으면 표준 re)
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
 from langchain.schema.output_parser import StrOutputParser
+from pydantic import BaseModel, Field
+from typing import List
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- 1. 애플리케이션 기본 설정 및 프롬프트 ---
 st.set_page_config(page_title="AI 특허 분석 에이전트", layout="wide")
 
+# 프롬프트를 수정하면 이 값을 올려서 기존 캐시 항목이 재사용되지 않도록 합니다.
+PROMPT_VERSION = "v2"
+CACHE_DB_PATH = "llm_answer_cache.sqlite3"
+SEMANTIC_CACHE_THRESHOLD = 0.95 # 코사인 유사도가 이 값 이상이면 같은 질문으로 간주
+
+# 최종 답변 프롬프트에 넣을 문서 분량 제한 (LLM 입력 토큰이 3단계의 비용/지연을 좌우함)
+MAX_DOC_CHARS = 4000 # 문서 하나당 최대 글자 수
+DOC_LEADING_CHARS = 500 # 키워드가 처음 등장하는 위치보다 앞쪽으로 함께 포함할 글자 수
+CONTEXT_CHAR_BUDGET = 60000 # 전체 컨텍스트 최대 글자 수 (검색 순위가 높은 문서부터 채움)
+RERANK_TOP_M = 10 # DB 서버 재정렬 후 최종 답변에 사용할 최대 문서 수 (선행 검색 결과를 합친 뒤에도 적용)
+
 # [프롬프트 1] 키워드 추출용
 KEYWORD_EXTRACTION_PROMPT = PromptTemplate.from_template(
     """
     You are an expert in semiconductor and patent search. Your task is to extract the most relevant and effective search keywords from the user's question.
-    The keywords should be concise technical terms. Output them as a comma-separated list.
+    The keywords should be concise technical terms.
     
     User's Question: {question}
-    
-    Keywords:
     """
 )
 
+# 키워드 추출 결과 스키마 (Gemini 구조화 출력으로 바로 리스트를 받아 문자열 파싱을 생략)
+class SearchKeywords(BaseModel):
+    keywords: List[str] = Field(description="Concise technical search keywords extracted from the user's question")
+
 # [프롬프트 2] 종합 답변 생성용
 FINAL_ANSWER_PROMPT = PromptTemplate.from_template(
     """
@@ -81,9 +111,216 @@ with st.sidebar:
         st.session_state.messages = []
         st.rerun()
 
+# --- LLM 및 체인 캐싱 (매 질문마다 클라이언트/파이프라인을 다시 만들지 않도록) ---
+@st.cache_resource(show_spinner=False)
+def get_llm(model, api_key):
+    return ChatGoogleGenerativeAI(model=model, google_api_key=api_key, temperature=0.1)
+
+@st.cache_resource(show_spinner=False)
+def get_chains(model, api_key):
+    llm = get_llm(model, api_key)
+    return {
+        "keyword": KEYWORD_EXTRACTION_PROMPT | llm.with_structured_output(SearchKeywords),
+        "summary": SINGLE_DOC_SUMMARY_PROMPT | llm | StrOutputParser(),
+        "final": FINAL_ANSWER_PROMPT | llm | StrOutputParser(),
+    }
+
+# --- DB 서버 HTTP 세션 (연결을 재사용하여 매 요청마다 TCP 핸드셰이크를 하지 않도록) ---
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_prefetch_executor():
+    # 키워드 추출(LLM) 동안 질문 문장 전체로 미리 검색해두기 위한 백그라운드 스레드
+    return ThreadPoolExecutor(max_workers=4)
+
+def search_documents(session, server_url, db_id, keywords, k_per_keyword=None, query=None, top_m=None):
+    """
+    DB 서버의 /search_by_keywords를 호출하여 중복 제거된 문서 리스트를 돌려줍니다.
+    query(원래 질문)를 함께 보내면 서버가 cross-encoder로 재정렬한 상위 문서만 돌려줍니다.
+    """
+    search_url = f"{server_url.rstrip('/')}/search_by_keywords"
+    search_payload = {"db_id": db_id, "keywords": keywords}
+    if k_per_keyword is not None:
+        search_payload["k_per_keyword"] = k_per_keyword
+    if query is not None:
+        search_payload["query"] = query
+    if top_m is not None:
+        search_payload["top_m"] = top_m
+    response = session.post(search_url, json=search_payload, timeout=60)
+    response.raise_for_status()
+    return orjson.loads(response.content).get('documents', [])
+
+def merge_ranked_documents(primary, secondary, top_m):
+    """
+    두 검색 결과를 출처 기준으로 중복 제거하여 합칩니다.
+    모든 문서에 서버 재정렬 점수(score)가 있으면 점수 순으로 정렬해 상위 top_m개만 남기고,
+    점수가 없으면(재정렬 미사용/구버전 서버) 순서와 개수를 그대로 둡니다.
+    """
+    merged = list(primary)
+    seen_sources = {doc['metadata'].get('source') for doc in merged}
+    for doc in secondary:
+        if doc['metadata'].get('source') not in seen_sources:
+            merged.append(doc)
+            seen_sources.add(doc['metadata'].get('source'))
+    if merged and all('score' in doc for doc in merged):
+        merged.sort(key=lambda doc: doc['score'], reverse=True)
+        merged = merged[:top_m]
+    return merged
+
+# --- 질의 캐시 (정확 일치 + 의미 유사도) ---
+# 같은 질문(또는 거의 같은 질문)에 대해 Gemini를 다시 호출하지 않도록 결과를 sqlite에 저장합니다.
+@st.cache_resource(show_spinner=False)
+def get_cache_db():
+    # 모든 세션(스레드)이 같은 연결을 공유하므로, 잠금도 함께 한 번만 만들어 돌려줌
+    conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "key TEXT PRIMARY KEY, scope TEXT NOT NULL, question TEXT, embedding BLOB, value TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_scope ON llm_cache (scope)")
+    conn.commit()
+    return conn, threading.Lock()
+
+def normalize_question(question):
+    return " ".join(question.strip().lower().split())
+
+def cache_key(scope, question):
+    return hashlib.sha256(f"{scope}|{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+def embed_question(server_url, question):
+    """DB 서버의 임베딩 모델로 질문 벡터를 얻습니다. 실패하면 None (의미 캐시는 건너뜀)."""
+    try:
+        embed_url = f"{server_url.rstrip('/')}/embed"
+        response = get_http_session().post(embed_url, json={"texts": [normalize_question(question)]}, timeout=30)
+        response.raise_for_status()
+        vector = np.asarray(orjson.loads(response.content)["embeddings"][0], dtype=np.float32)
+    except (requests.RequestException, orjson.JSONDecodeError, KeyError, IndexError, ValueError):
+        return None
+    vector /= max(np.linalg.norm(vector), 1e-12)
+    return vector
+
+def lazy_question_vector(server_url, question):
+    """
+    처음 호출될 때만 /embed를 요청하고, 이후에는 같은 벡터를 돌려주는 함수를 만듭니다.
+    정확 일치 캐시에서 찾으면 임베딩 요청 자체를 하지 않습니다.
+    """
+    computed = []
+    def get_vector():
+        if not computed:
+            computed.append(embed_question(server_url, question))
+        return computed[0]
+    return get_vector
+
+def cache_get(scope, question, get_vector):
+    conn, lock = get_cache_db()
+    key = cache_key(scope, question)
+    with lock:
+        row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        return json.loads(row[0])
+    vector = get_vector()
+    if vector is None:
+        return None
+    with lock:
+        rows = conn.execute(
+            "SELECT embedding, value FROM llm_cache WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+        ).fetchall()
+    if not rows:
+        return None
+    matrix = np.stack([np.frombuffer(emb, dtype=np.float32) for emb, _ in rows])
+    scores = matrix @ vector
+    best = int(np.argmax(scores))
+    if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return json.loads(rows[best][1])
+    return None
+
+def cache_put(scope, question, get_vector, value):
+    conn, lock = get_cache_db()
+    vector = get_vector()
+    embedding = vector.tobytes() if vector is not None else None
+    with lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, scope, question, embedding, value) VALUES (?, ?, ?, ?, ?)",
+            (cache_key(scope, question), scope, question, embedding, json.dumps(value, ensure_ascii=False)),
+        )
+
+# --- 검색 문서 → 프롬프트 컨텍스트 변환 ---
+def truncate_text(text, focus_terms):
+    """문서가 길면 키워드가 처음 등장하는 부근을 중심으로 MAX_DOC_CHARS만큼만 잘라냅니다."""
+    if len(text) <= MAX_DOC_CHARS:
+        return text
+    lowered = text.lower()
+    hits = [pos for pos in (lowered.find(term) for term in focus_terms) if pos != -1]
+    start = max(0, min(hits) - DOC_LEADING_CHARS) if hits else 0
+    return text[start:start + MAX_DOC_CHARS]
+
+def format_docs(docs, focus_terms=()):
+    focus_terms = [term.lower() for term in focus_terms if term]
+    parts = []
+    total_chars = 0
+    for doc in docs:
+        name = os.path.basename(doc['metadata'].get('source', 'N/A'))
+        part = f"--- Source: {name} ---\n{truncate_text(doc['page_content'], focus_terms)}"
+        if parts and total_chars + len(part) > CONTEXT_CHAR_BUDGET:
+            break
+        parts.append(part)
+        total_chars += len(part)
+    return "\n\n".join(parts)
+
 # [업그레이드] 특허 번호를 더 유연하게 감지하는 정규 표현식
 # (US|KR|CN|JP|EP)로 시작하고, 중간에 공백, 점, 하이픈이 있어도 되며, 뒤에 문자(A1, B, P 등)가 붙어도 되는 패턴
-PATENT_NUMBER_REGEX = re.compile(r'((?:US|KR|CN|JP|EP)[\s.-]?\d{4,}[\s.-]?\d+[A-Z\d]*)', re.IGNORECASE)
+PATENT_NUMBER_PATTERN = r'((?:US|KR|CN|JP|EP)[\s.-]?\d{4,}[\s.-]?\d+[A-Z\d]*)'
+# Hyperscan/RE2의 \s, \d는 ASCII만 매칭하므로, re(str 모드)와 같은 유니코드 문자 집합을 명시한 패턴
+# (\s = Z 범주 + \t\n\v\f\r + \x1c-\x1f + \x85, \d = Nd 범주. 예: 전각 공백 U+3000, 전각 숫자 '２０２３')
+UNICODE_PATENT_NUMBER_PATTERN = (
+    PATENT_NUMBER_PATTERN
+    .replace(r'\s', r'\s\x{0b}\x{1c}-\x{1f}\x{85}\p{Z}')
+    .replace(r'\d', r'\p{Nd}')
+)
+
+@st.cache_resource(show_spinner=False)
+def get_patent_number_finder():
+    """
+    질문에서 첫 번째 특허 번호를 찾아 돌려주는 함수를 만듭니다. (없으면 None)
+    Hyperscan/RE2는 DFA 기반이라 입력 길이에 비례하는 시간만 걸리고 백트래킹 폭주가 없습니다.
+    """
+    if hyperscan is not None:
+        database = hyperscan.Database()
+        database.compile(
+            expressions=[UNICODE_PATENT_NUMBER_PATTERN.encode()], ids=[0],
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP],
+        )
+        scan_lock = threading.Lock() # 스크래치 공간을 세션(스레드) 간에 공유하므로 동시 스캔 방지
+
+        def find_with_hyperscan(text):
+            matches = []
+            def on_match(_id, start, end, _flags, _context):
+                matches.append((start, -end))
+            data = text.encode("utf-8")
+            with scan_lock:
+                database.scan(data, match_event_handler=on_match)
+            if not matches:
+                return None
+            # 가장 왼쪽에서 시작하는 가장 긴 매치 = re의 탐욕적 매칭 결과와 동일 (UTF-8 모드라 문자 경계에서만 끝남)
+            start, negative_end = min(matches)
+            return data[start:-negative_end].decode("utf-8")
+        return find_with_hyperscan
+
+    if re2 is not None:
+        compiled = re2.compile("(?i)" + UNICODE_PATENT_NUMBER_PATTERN)
+    else:
+        compiled = re.compile(PATENT_NUMBER_PATTERN, re.IGNORECASE)
+
+    def find_with_regex(text):
+        match = compiled.search(text)
+        return match.group(1) if match else None
+    return find_with_regex
 
 # --- 3. 메인 Q&A 로직 (지능형 듀얼 모드) ---
 st.title(f"🤖 AI 특허 분석 에이전트 ({selected_db_name})")
@@ -106,65 +343,84 @@ else:
 
         with st.chat_message("assistant"):
             try:
-                llm = ChatGoogleGenerativeAI(model=selected_model, google_api_key=gemini_api_key, temperature=0.1)
+                chains = get_chains(selected_model, gemini_api_key)
                 
                 # [핵심] 사용자의 질문 유형을 먼저 판단
-                patent_match = PATENT_NUMBER_REGEX.search(user_question)
+                patent_number = get_patent_number_finder()(user_question)
                 
                 # --- 모드 1: 특정 특허 번호 요약 ---
-                if patent_match:
-                    patent_number = patent_match.group(1)
+                if patent_number:
                     st.info(f"특정 특허 '{patent_number}'에 대한 요약을 요청합니다...")
                     
                     with st.spinner("DB 서버에서 해당 특허 문서를 검색하는 중..."):
-                        search_url = f"{db_server_url.rstrip('/')}/search_by_keywords"
                         # 키워드로 특허 번호를 보내면, 가장 유사한 자기 자신이 검색됨
-                        search_payload = {"db_id": selected_db_id, "keywords": [patent_number], "k_per_keyword": 1}
-                        response = requests.post(search_url, json=search_payload, timeout=60)
-                        response.raise_for_status()
-                        retrieved_data = response.json().get('documents', [])
+                        retrieved_data = search_documents(
+                            get_http_session(), db_server_url, selected_db_id, [patent_number], k_per_keyword=1
+                        )
 
                     if not retrieved_data:
                         st.error(f"DB에서 '{patent_number}'에 해당하는 특허를 찾지 못했습니다.")
                     else:
                         with st.spinner("Gemini가 해당 특허를 정밀 요약하는 중..."):
                             doc_content = retrieved_data[0]['page_content']
-                            summary_chain = SINGLE_DOC_SUMMARY_PROMPT | llm | StrOutputParser()
-                            final_answer = summary_chain.invoke({"context": doc_content})
-                            st.markdown(final_answer)
+                            final_answer = st.write_stream(chains["summary"].stream({"context": doc_content}))
                             st.session_state.messages.append({"role": "assistant", "content": final_answer})
 
                 # --- 모드 2: AI 리서치 에이전트 ---
                 else:
+                    # 키워드 추출을 기다리는 동안 질문 문장 자체로 검색을 먼저 시작 (검색 지연을 LLM 호출 뒤에 숨김)
+                    http_session = get_http_session()
+                    # query도 함께 보내 서버가 같은 기준(cross-encoder)으로 점수를 매기게 하여, 키워드 결과와 점수로 합칠 수 있게 함
+                    prefetch_future = get_prefetch_executor().submit(
+                        search_documents, http_session, db_server_url, selected_db_id, [user_question],
+                        query=user_question, top_m=RERANK_TOP_M,
+                    )
+
                     with st.spinner("1/3: 질문을 분석하여 검색 키워드를 추출하는 중..."):
-                        keyword_chain = KEYWORD_EXTRACTION_PROMPT | llm | StrOutputParser()
-                        extracted_keywords = keyword_chain.invoke({"question": user_question})
-                        keyword_list = [k.strip() for k in extracted_keywords.split(',') if k.strip()]
+                        get_question_vector = lazy_question_vector(db_server_url, user_question)
+                        keyword_scope = f"{PROMPT_VERSION}|{selected_model}|keywords"
+                        keyword_list = cache_get(keyword_scope, user_question, get_question_vector)
+                        if keyword_list is None:
+                            extracted_keywords = chains["keyword"].invoke({"question": user_question})
+                            # 모델이 구조화 출력(tool call)을 내지 않으면 None → 빈 리스트 (미리 검색한 결과로 답변)
+                            keywords = extracted_keywords.keywords if extracted_keywords is not None else []
+                            keyword_list = [k.strip() for k in keywords if k.strip()]
+                            if keyword_list:
+                                cache_put(keyword_scope, user_question, get_question_vector, keyword_list)
+                        else:
+                            st.caption("⚡ 이전에 분석한 질문과 같아 캐시된 키워드를 사용합니다.")
                         st.info(f"🔍 추출된 검색 키워드: `{', '.join(keyword_list)}`")
 
                     with st.spinner(f"2/3: DB 서버에서 '{len(keyword_list)}'개 키워드로 관련 특허를 검색하는 중..."):
-                        search_url = f"{db_server_url.rstrip('/')}/search_by_keywords"
-                        search_payload = {"db_id": selected_db_id, "keywords": keyword_list}
-                        response = requests.post(search_url, json=search_payload, timeout=60)
-                        response.raise_for_status()
-                        retrieved_data = response.json().get('documents', [])
+                        retrieved_data = search_documents(
+                            http_session, db_server_url, selected_db_id, keyword_list,
+                            query=user_question, top_m=RERANK_TOP_M,
+                        ) if keyword_list else []
+                        try:
+                            prefetched_data = prefetch_future.result()
+                        except (requests.RequestException, ValueError) as e:
+                            # 추측성 선행 검색이 실패해도 키워드 검색 결과만으로 계속 진행
+                            st.caption(f"질문 문장 선행 검색에 실패하여 키워드 검색 결과만 사용합니다: {e}")
+                            prefetched_data = []
+                        # 미리 검색해둔 질문 문장 결과와 합친 뒤 재정렬 점수 기준 상위 top_m개만 LLM 컨텍스트로 사용
+                        retrieved_data = merge_ranked_documents(retrieved_data, prefetched_data, RERANK_TOP_M)
                     
                     if not retrieved_data:
                         st.warning("관련된 특허 문서를 찾지 못했습니다.")
                     else:
                         st.success(f"📄 총 {len(retrieved_data)}개의 관련 특허를 찾았습니다. 이제 종합하여 답변을 생성합니다.")
                         with st.spinner("3/3: Gemini가 검색된 문헌을 종합하여 최종 답변을 작성하는 중..."):
-                            def format_docs(docs):
-                                return "\n\n".join([f"--- Source: {os.path.basename(doc['metadata'].get('source', 'N/A'))} ---\n{doc['page_content']}" for doc in docs])
-                            
-                            final_rag_chain = (
-                                {"context": lambda x: format_docs(retrieved_data), "question": RunnablePassthrough()}
-                                | FINAL_ANSWER_PROMPT
-                                | llm
-                                | StrOutputParser()
-                            )
-                            final_answer = final_rag_chain.invoke(user_question)
-                            st.markdown(final_answer)
+                            sources = sorted(os.path.basename(doc['metadata'].get('source', 'N/A')) for doc in retrieved_data)
+                            answer_scope = f"{PROMPT_VERSION}|{selected_model}|final|{'|'.join(sources)}"
+                            final_answer = cache_get(answer_scope, user_question, get_question_vector)
+                            if final_answer is None:
+                                # 토큰이 생성되는 대로 화면에 출력하고, 완성된 전체 답변 문자열을 돌려받음
+                                final_answer = st.write_stream(chains["final"].stream(
+                                    {"context": format_docs(retrieved_data, keyword_list), "question": user_question}
+                                ))
+                                cache_put(answer_scope, user_question, get_question_vector, final_answer)
+                            else:
+                                st.markdown(final_answer)
                             st.session_state.messages.append({"role": "assistant", "content": final_answer})
 
             except Exception as e:
@@ -3,6 +3,7 @@ from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import List
 import os
+import functools
 
 # LangChain 및 DB 관련 라이브러리
 from langchain_community.vectorstores import FAISS
@@ -33,6 +34,11 @@ for db_id, folder_name in db_folders.items():
 
 app = FastAPI()
 
+@functools.lru_cache(maxsize=32)
+def get_retriever(db_id: str, k: int):
+    # (DB, k) 조합마다 retriever를 한 번만 만들어 재사용
+    return available_dbs[db_id].as_retriever(search_kwargs={'k': k})
+
 class SearchRequest(BaseModel):
     db_id: str
     keywords: List[str]
@@ -45,23 +51,22 @@ def search_by_keywords(request: SearchRequest):
     if request.db_id not in available_dbs:
         raise HTTPException(status_code=404, detail=f"'{request.db_id}' DB를 찾을 수 없습니다.")
     
-    vector_db = available_dbs[request.db_id]
+    retriever = get_retriever(request.db_id, request.k_per_keyword)
     
     try:
-        all_retrieved_docs = []
+        # 문서를 찾는 즉시 응답용 dict로 변환하여 한 번의 순회로 중복 제거
+        results = []
         unique_doc_sources = set()
 
         for keyword in request.keywords:
-            retriever = vector_db.as_retriever(search_kwargs={'k': request.k_per_keyword})
             retrieved_docs = retriever.invoke(keyword)
             
             for doc in retrieved_docs:
                 source = doc.metadata.get('source')
                 if source not in unique_doc_sources:
-                    all_retrieved_docs.append(doc)
                     unique_doc_sources.add(source)
+                    results.append({"page_content": doc.page_content, "metadata": doc.metadata})
         
-        results = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in all_retrieved_docs]
         print(f"-> 총 {len(results)}개의 고유 문서를 찾았습니다.")
         return {"documents": results}
     except Exception as e:
@@ -1,49 +1,327 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field
+from typing import List, Optional
 import os
+import asyncio
+import pickle
+import functools
+import threading
+import numpy as np
+import faiss
+import orjson
+import torch
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # LangChain 및 DB 관련 라이브러리
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import CrossEncoder
 
 # --- 1. 초기 설정 및 모델/DB 로딩 ---
 
+# int8로 양자화한 ONNX 임베딩 모델 폴더 (README의 'ONNX 임베딩 모델 만들기' 참고). 없으면 PyTorch 모델 사용
+ONNX_EMBEDDER_DIR = "onnx_ko_sroberta_int8"
+ONNX_MODEL_FILENAME = "model_quantized.onnx"
+ONNX_PROVIDERS = ["CPUExecutionProvider"] # int8 동적 양자화 연산은 CPU(VNNI)에서 가장 빠름
+
+class OnnxSentenceEmbeddings(Embeddings):
+    """
+    ONNX Runtime으로 ko-sroberta를 실행하는 임베딩 클래스입니다.
+    sentence-transformers와 같은 방식(attention mask 기준 mean pooling)으로 문장 벡터를 만듭니다.
+    """
+    def __init__(self, model_dir, batch_size=32, max_length=128):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(os.path.join(model_dir, ONNX_MODEL_FILENAME), providers=ONNX_PROVIDERS)
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True,
+                max_length=self.max_length, return_tensors="np",
+            )
+            inputs = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def enable_fp16_inference(sentence_model):
+    """
+    SentenceTransformer.encode를 inference_mode + fp16 autocast 안에서 실행하도록 감쌉니다.
+    (Ampere 이상 GPU에서 텐서 코어를 사용하여 BERT 순전파 시간을 줄임)
+    """
+    original_encode = sentence_model.encode
+
+    @functools.wraps(original_encode)
+    def encode(*args, **kwargs):
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16):
+            return original_encode(*args, **kwargs)
+
+    sentence_model.encode = encode
+
+WARMUP_BATCH = ["warmup"] * 8 # 시작 시 한 번 실행하여 CUDA 컨텍스트/cuBLAS 핸들을 미리 초기화
+TORCH_DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu' # 임베딩 모델과 재정렬 모델이 함께 사용하는 장치
+
 print("AI 에이전트용 DB 서버 초기화 중...")
 print("임베딩 모델을 로드합니다. (최초 실행 시 시간이 걸릴 수 있습니다)")
-embeddings = HuggingFaceEmbeddings(
-    model_name="jhgan/ko-sroberta-multitask",
-    model_kwargs={'device': 'cuda'}
-)
+if os.path.exists(os.path.join(ONNX_EMBEDDER_DIR, ONNX_MODEL_FILENAME)):
+    print(f"int8 ONNX 임베딩 모델을 사용합니다: {ONNX_EMBEDDER_DIR}")
+    embeddings = OnnxSentenceEmbeddings(ONNX_EMBEDDER_DIR)
+else:
+    embeddings = HuggingFaceEmbeddings(
+        model_name="jhgan/ko-sroberta-multitask",
+        model_kwargs={'device': TORCH_DEVICE}
+    )
+    if TORCH_DEVICE == 'cuda':
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        enable_fp16_inference(embeddings._client)
+embeddings.embed_documents(WARMUP_BATCH)
 print("임베딩 모델 로드 완료.")
 
+# 검색 결과 재정렬(cross-encoder) 설정: 질문과 문서를 함께 보고 점수를 매겨 상위 문서만 LLM에 전달
+USE_RERANKER = True
+RERANKER_MODEL = "BAAI/bge-reranker-base"
+RERANK_TOP_M = 10 # 재정렬 후 돌려줄 최대 문서 수
+RERANK_MAX_CHARS = 512 # 재정렬 점수 계산에 사용할 문서 앞부분 글자 수
+
+reranker = None
+if USE_RERANKER:
+    print(f"재정렬 모델을 로드합니다: {RERANKER_MODEL}")
+    reranker = CrossEncoder(RERANKER_MODEL, device=TORCH_DEVICE)
+    reranker.predict([(text, text) for text in WARMUP_BATCH])
+    print("재정렬 모델 로드 완료.")
+
 available_dbs = {}
 db_folders = {
     "core_patents": "faiss_index_core_patents_gpu",
 }
 
+# 검색 인덱스 가속 설정: faiss-gpu가 있으면 GPU로 올리고, 없으면 CPU HNSW 그래프 인덱스로 변환
+USE_FAISS_GPU = True
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+gpu_resources = None # 요청마다 다시 만들지 않도록 모듈 전역으로 한 번만 생성
+gpu_search_lock = threading.Lock() # FAISS GPU 인덱스/StandardGpuResources는 여러 스레드에서 동시에 쓸 수 없음
+
+# int8 스칼라 양자화(IVF-SQ8) 인덱스 설정: 벡터당 메모리를 fp32의 1/4로 줄여 검색 시 메모리 대역폭 절감
+USE_INT8_INDEX = True
+SQ8_INDEX_FILENAME = "index_ivf_sq8.faiss" # DB 폴더에 저장해두고 다음 실행부터 재사용
+IVF_NPROBE = 16
+
+def load_docstore(db_path):
+    """FAISS.load_local과 같은 index.pkl에서 (docstore, index_to_docstore_id)를 읽습니다."""
+    with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+        return pickle.load(f)
+
+def load_flat_index(db_path):
+    """
+    FAISS.load_local과 같은 index.faiss를 메모리로 읽습니다.
+    (메모리 매핑하지 않음: convert_to_cosine_index와 accelerate_index가 곧바로 모든 벡터를 복원해
+    워커마다 별도 인덱스를 만들기 때문에 매핑해도 이득이 없음. 매핑은 저장된 int8 인덱스 경로에서만 사용)
+    """
+    return faiss.read_index(os.path.join(db_path, "index.faiss"))
+
+def mark_cosine_index(vector_db):
+    vector_db.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+    vector_db._normalize_L2 = True # 질의 벡터도 같은 방식으로 정규화 (embed_queries 참고)
+
+def convert_to_cosine_index(vector_db):
+    """
+    저장된 벡터를 로드 시점에 한 번 정규화하여 내적(IP) 인덱스로 바꿉니다.
+    정규화된 벡터에서는 코사인 유사도 == 내적이므로 L2 거리 계산 없이 단일 행렬곱으로 검색됩니다.
+    """
+    index = vector_db.index
+    if not isinstance(index, faiss.IndexFlat) or index.metric_type != faiss.METRIC_L2:
+        return
+    vectors = index.reconstruct_n(0, index.ntotal)
+    faiss.normalize_L2(vectors)
+    ip_index = faiss.IndexFlatIP(index.d)
+    ip_index.add(vectors)
+    vector_db.index = ip_index
+    mark_cosine_index(vector_db)
+
+def load_saved_sq8_index(db_path, ntotal):
+    """
+    이전 실행에서 저장한 int8 인덱스를 메모리 매핑(IVF 역색인 리스트)으로 읽습니다.
+    CPU에서는 이 매핑된 인덱스를 그대로 검색하므로 페이지가 필요할 때만 읽히고 워커 간에 공유됩니다.
+    (GPU를 쓰면 accelerate_index가 인덱스를 GPU 메모리로 복사하므로 시작 시 읽기 비용만 줄어듦)
+    없거나, index.faiss/index.pkl보다 오래되었거나, 현재 DB와 벡터 수/거리 방식이 다르면 None.
+    int8 인덱스는 convert_to_cosine_index로 정규화한 내적 인덱스에서만 만들어지므로(quantize_index 호출부 참고),
+    이 경우 원본 index.faiss를 읽어 코사인 변환하는 과정을 통째로 건너뛸 수 있습니다.
+    """
+    sq8_path = os.path.join(db_path, SQ8_INDEX_FILENAME)
+    if not os.path.exists(sq8_path):
+        return None
+    # DB를 다시 만들면(벡터 수가 같더라도) id ↔ 문서 매핑이 달라지므로 원본보다 오래된 저장본은 사용하지 않음
+    source_mtime = max(os.path.getmtime(os.path.join(db_path, name)) for name in ("index.faiss", "index.pkl"))
+    if os.path.getmtime(sq8_path) < source_mtime:
+        print(f"저장된 int8 인덱스가 DB보다 오래되어 다시 생성합니다: {sq8_path}")
+        return None
+    sq8_index = faiss.read_index(sq8_path, faiss.IO_FLAG_MMAP)
+    if sq8_index.ntotal != ntotal or sq8_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        print(f"저장된 int8 인덱스가 현재 DB와 맞지 않아 다시 생성합니다: {sq8_path}")
+        return None
+    sq8_index.nprobe = IVF_NPROBE
+    return sq8_index
+
+def quantize_index(index, db_path):
+    """
+    (정규화된) 평탄 인덱스를 IVF + int8 스칼라 양자화 인덱스로 변환합니다.
+    학습 비용이 있으므로 DB 폴더에 저장해두고, 다음 실행부터는 load_saved_sq8_index로 읽습니다.
+    """
+    if not isinstance(index, faiss.IndexFlat):
+        return index
+    sq8_path = os.path.join(db_path, SQ8_INDEX_FILENAME)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    nlist = max(1, int(np.sqrt(index.ntotal)))
+    coarse_quantizer = faiss.IndexFlat(index.d, index.metric_type)
+    sq8_index = faiss.IndexIVFScalarQuantizer(
+        coarse_quantizer, index.d, nlist, faiss.ScalarQuantizer.QT_8bit, index.metric_type
+    )
+    sq8_index.train(vectors)
+    sq8_index.add(vectors)
+    sq8_index.nprobe = IVF_NPROBE
+    # 다른 워커가 쓰는 도중의 파일을 읽지 않도록, 같은 폴더의 임시 파일에 쓴 뒤 한 번에 교체
+    tmp_path = f"{sq8_path}.{os.getpid()}.tmp"
+    try:
+        faiss.write_index(sq8_index, tmp_path)
+        os.replace(tmp_path, sq8_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sq8_index
+
+def accelerate_index(index):
+    global gpu_resources
+    if USE_FAISS_GPU and hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+        if gpu_resources is None:
+            gpu_resources = faiss.StandardGpuResources()
+        return faiss.index_cpu_to_gpu(gpu_resources, 0, index)
+    if isinstance(index, faiss.IndexFlat):
+        hnsw_index = faiss.IndexHNSWFlat(index.d, HNSW_M, index.metric_type)
+        hnsw_index.hnsw.efSearch = HNSW_EF_SEARCH
+        hnsw_index.add(index.reconstruct_n(0, index.ntotal))
+        return hnsw_index
+    return index
+
+def search_index(index, query_vectors, k):
+    """인덱스를 검색합니다. GPU 인덱스는 한 번에 한 스레드만 검색하도록 잠금을 겁니다."""
+    if hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex):
+        with gpu_search_lock:
+            return index.search(query_vectors, k)
+    return index.search(query_vectors, k)
 
 for db_id, folder_name in db_folders.items():
     db_path = os.path.join('.', folder_name)
     if os.path.exists(db_path):
         print(f"'{db_id}' DB 로딩 중...")
-        available_dbs[db_id] = FAISS.load_local(
-            db_path, embeddings, allow_dangerous_deserialization=True
-        )
+        docstore, index_to_docstore_id = load_docstore(db_path)
+        # 저장된 int8 인덱스가 유효하면 원본 index.faiss는 아예 읽지 않음 (벡터 수는 docstore id 매핑으로 확인)
+        sq8_index = load_saved_sq8_index(db_path, len(index_to_docstore_id)) if USE_INT8_INDEX else None
+        if sq8_index is not None:
+            vector_db = FAISS(embeddings, sq8_index, docstore, index_to_docstore_id)
+            mark_cosine_index(vector_db)
+        else:
+            vector_db = FAISS(embeddings, load_flat_index(db_path), docstore, index_to_docstore_id)
+            convert_to_cosine_index(vector_db)
+            if USE_INT8_INDEX and vector_db._normalize_L2:
+                vector_db.index = quantize_index(vector_db.index, db_path)
+        vector_db.index = accelerate_index(vector_db.index)
+        available_dbs[db_id] = vector_db
         print(f"'{db_id}' DB 로드 완료.")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse) # 큰 문서 본문을 orjson(C 구현)으로 직렬화
 
 class SearchRequest(BaseModel):
     db_id: str
     keywords: List[str]
     k_per_keyword: int = 5 # 각 키워드당 몇 개의 문서를 찾을지
+    query: Optional[str] = None # 사용자의 원래 질문 (있으면 cross-encoder로 재정렬하고 문서마다 score를 붙여 반환)
+    top_m: int = Field(RERANK_TOP_M, gt=0) # 재정렬 후 몇 개의 문서를 돌려줄지
+
+def rerank_documents(query, documents, top_m):
+    """
+    cross-encoder 점수가 높은 순으로 문서를 정렬하여 상위 top_m개만 남깁니다.
+    클라이언트가 여러 검색 결과를 같은 기준으로 합칠 수 있도록 각 문서에 "score"를 붙입니다.
+    """
+    pairs = [(query, doc["page_content"][:RERANK_MAX_CHARS]) for doc in documents]
+    scores = np.asarray(reranker.predict(pairs), dtype=np.float32)
+    order = np.argsort(-scores)[:top_m]
+    return [{**documents[i], "score": float(scores[i])} for i in order]
+
+def embed_queries(vector_db, texts):
+    """검색어들을 한 번에 임베딩하여 FAISS 질의용 float32 행렬로 만듭니다."""
+    query_vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    if vector_db._normalize_L2:
+        faiss.normalize_L2(query_vectors)
+    return query_vectors
+
+# 검색 결과(특허 본문)는 수백 KB가 될 수 있으므로, 클라이언트가 지원하면 zstd로 압축해서 보냄
+ZSTD_LEVEL = 3
+ZSTD_MIN_BYTES = 1024 # 이보다 작은 응답은 압축 이득이 없어 그대로 전송
+zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard is not None else None
+
+def accepts_encoding(accept_encoding, coding):
+    """
+    Accept-Encoding 헤더의 coding/q 값을 해석하여 coding을 허용하는지(q > 0) 확인합니다.
+    coding이 명시되지 않았으면 '*' 항목을 따르고, 둘 다 없으면 허용하지 않습니다. (예: 'zstd;q=0' → False)
+    """
+    wildcard_q = None
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if name == coding:
+            return q > 0
+        if name == "*":
+            wildcard_q = q
+    return wildcard_q is not None and wildcard_q > 0
+
+def json_response(payload, http_request: Request):
+    # ORJSONResponse와 같은 옵션: 정수 키 metadata, numpy 값도 직렬화
+    body = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    accept_encoding = http_request.headers.get("accept-encoding", "")
+    if zstd_compressor is not None and accepts_encoding(accept_encoding, "zstd") and len(body) >= ZSTD_MIN_BYTES:
+        return Response(
+            content=zstd_compressor.compress(body), media_type="application/json",
+            headers={"Content-Encoding": "zstd", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=body, media_type="application/json", headers={"Vary": "Accept-Encoding"})
 
 # --- 2. 업그레이드된 API 엔드포인트 ---
+# 임베딩/FAISS 검색처럼 블로킹되는 작업은 asyncio.to_thread로 넘겨 이벤트 루프를 막지 않습니다.
 
 @app.post("/search_by_keywords")
-def search_by_keywords(request: SearchRequest):
+async def search_by_keywords(request: SearchRequest, http_request: Request):
     """
     키워드 리스트를 받아, 각 키워드에 대해 문서를 검색하고 중복을 제거한 뒤 결과를 반환합니다.
     """
@@ -54,26 +332,48 @@ def search_by_keywords(request: SearchRequest):
     vector_db = available_dbs[request.db_id]
     
     try:
-        all_retrieved_docs = []
+        # 문서를 찾는 즉시 응답용 dict로 변환하여 한 번의 순회로 중복 제거
+        results = []
         unique_doc_sources = set()
 
-        for keyword in request.keywords:
-            retriever = vector_db.as_retriever(search_kwargs={'k': request.k_per_keyword})
-            retrieved_docs = retriever.invoke(keyword)
-            
-            for doc in retrieved_docs:
+        if request.keywords:
+            # 모든 키워드를 한 번에 임베딩하고 FAISS 검색도 한 번만 수행 (키워드별 N회 호출 대신 배치 1회)
+            query_vectors = await asyncio.to_thread(embed_queries, vector_db, request.keywords)
+            _, indices = await asyncio.to_thread(search_index, vector_db.index, query_vectors, request.k_per_keyword)
+
+            # 키워드 순서 → 키워드 내 순위 순으로 순회하며 중복 제거
+            for idx in indices.flatten():
+                if idx == -1:
+                    continue
+                doc = vector_db.docstore.search(vector_db.index_to_docstore_id[int(idx)])
                 source = doc.metadata.get('source')
                 if source not in unique_doc_sources:
-                    all_retrieved_docs.append(doc)
                     unique_doc_sources.add(source)
+                    results.append({"page_content": doc.page_content, "metadata": doc.metadata})
         
-        results = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in retrieved_docs]
+        if reranker is not None and request.query and results:
+            results = await asyncio.to_thread(rerank_documents, request.query, results, request.top_m)
+            print(f"-> 재정렬 후 상위 {len(results)}개 문서만 반환합니다.")
         
         print(f"-> 총 {len(results)}개의 고유 문서를 찾았습니다.")
-        return {"documents": results}
+        return json_response({"documents": results}, http_request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"키워드 검색 중 서버 오류 발생: {e}")
 
+class EmbedRequest(BaseModel):
+    texts: List[str]
+
+@app.post("/embed")
+async def embed_texts(request: EmbedRequest):
+    """
+    이미 로드된 임베딩 모델로 텍스트를 벡터화합니다. (클라이언트의 의미 유사도 캐시용)
+    """
+    try:
+        return {"embeddings": await asyncio.to_thread(embeddings.embed_documents, request.texts)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"임베딩 생성 중 서버 오류 발생: {e}")
+
 if __name__ == "__main__":
     print("DB 검색 API 서버를 시작하려면 Anaconda Prompt에서 아래 명령어를 입력하세요:")
-    print("uvicorn db_api_server_agent:app --host 0.0.0.0 --port 8000")
+    print("uvicorn db_api_server_agent:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools")
+    print("(GPU 메모리에 여유가 있으면 --workers 2 처럼 워커 수를 늘릴 수 있습니다. 워커마다 모델과 인덱스를 따로 로드합니다.)")